@@ -1,7 +1,19 @@
 #!.venv/bin/python
 
+import atexit
+import bisect
+import collections
+import dbm
+import io
+import itertools
+import logging
+import multiprocessing
 import os
-import shutil
+import re
+import pathlib
+import shelve
+import sys
+import zipfile
 from fpdf import FPDF
 from datetime import datetime
 
@@ -21,8 +33,11 @@ PT_TO_MM = 0.352778
 HEIGHT = 11 * IN_TO_MM
 WIDTH = 17 * IN_TO_MM
 
+FONT_FILE = "./Fontdinerdotcom-unlocked.ttf"
+
 LEADING = 5  # mm - extra spacing between lines
-DEBUG = False  # set to True to see lines and bounding boxes
+# run with HUBBA_DEBUG=1 to see lines and bounding boxes, and log the fitting
+DEBUG = os.environ.get("HUBBA_DEBUG") == "1"
 
 # when trying to find the next font size that fits, what do we step by?
 FONT_STEP = 2
@@ -31,15 +46,131 @@ FONT_STEP = 2
 FONT_MIN = 100
 FONT_MAX = 800
 
+# how many times to re-wrap the text when estimating a font size to start from
+ESTIMATE_ROUNDS = 3
+
+# how many font steps either side of estimate_font_size() to look before
+# doubling the search window
+SEARCH_SPAN = 2
+
 MAX_TOKENS_PER_LINE = 3
-# Check whether the specified path exists or not
+
+# starting a process costs about as much as fitting a dozen or so signs, so
+# don't bother going parallel unless each process gets at least this many
+MIN_NAMES_PER_PROCESS = 16
+
+# fitted font metrics are kept here between command line runs. bump the
+# version whenever the fitting changes so old results aren't reused.
+METRICS_CACHE = ".sign_cache"
+METRICS_CACHE_VERSION = 1
+
+# how many fitted names each process keeps in memory when there's no shelf,
+# so a long running server doesn't hang on to every name it's ever been sent
+METRICS_CACHE_SIZE = 1024
+
+# the fonts in the PDFs are already compressed, so zipping them up harder
+# than this takes longer for next to no gain
+ZIP_LEVEL = 1
+
+# what make_from_file(all_in_one=True) calls the PDF with every sign in it
+ALL_IN_ONE_NAME = "all_signs.pdf"
 
 # current date and time
 now = datetime.now()
 OUTDIR = now.strftime("%Y_%m_%d")
 
-if not os.path.exists(OUTDIR):
-    os.makedirs(OUTDIR)
+os.makedirs(OUTDIR, exist_ok=True)
+
+logger = logging.getLogger(__name__)
+
+# characters we don't want in a sign's file name. Names come from the web
+# form too, and a / in one would otherwise point the PDF at another directory
+_FILENAME_TRANS = str.maketrans({" ": "_", "/": "_", "\\": "_", ":": "_"})
+
+# fpdf only has widths for characters up to U+FFFF and crashes writing out a
+# font with anything past that (emoji, mostly), so those come out of names,
+# along with the space in front of them
+_OUTSIDE_BMP = re.compile(r"\s*[\U00010000-\U0010FFFF]+")
+
+# parsed fonts keyed on the add_font() arguments, shared by every PDF so we
+# only unpickle the TTF metrics once per process
+_FONT_CACHE = {}
+
+
+class MetricsLRU(collections.OrderedDict):
+    """in-memory metrics cache that forgets the least recently used names"""
+
+    def __init__(self, maxsize=METRICS_CACHE_SIZE):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def open_metrics_cache():
+    """
+    open the on-disk metrics cache, or an in-memory one if another process
+    has it. Most dbm backends (dbm.dumb included) happily let several writers
+    corrupt the shelf, so we hold an exclusive lock on it for as long as it's
+    open.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        # no flock on Windows, so don't risk it
+        logger.warning("metrics cache needs fcntl, not persisting")
+        return MetricsLRU()
+
+    lock = None
+    try:
+        lock = open(METRICS_CACHE + ".lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        cache = shelve.open(METRICS_CACHE)
+    except (dbm.error[0], OSError) as exc:
+        if lock is not None:
+            lock.close()
+        logger.warning("metrics cache unavailable, not persisting: %s", exc)
+        return MetricsLRU()
+
+    # atexit runs these last first, so the shelf is closed before the lock
+    atexit.register(lock.close)
+    atexit.register(cache.close)
+    return cache
+
+
+_METRICS_CACHE = None
+
+
+def get_metrics_cache():
+    """
+    the metrics cache for this process. That's a MetricsLRU holding the last
+    METRICS_CACHE_SIZE names unless use_metrics_shelf() has been called.
+    """
+    global _METRICS_CACHE
+
+    if _METRICS_CACHE is None:
+        _METRICS_CACHE = MetricsLRU()
+    return _METRICS_CACHE
+
+
+def use_metrics_shelf():
+    """
+    keep fitted metrics on disk between runs. Only the command line does
+    this - the web server runs several workers that would fight over the
+    shelf, and it would fill up with every name anyone ever typed in.
+    """
+    global _METRICS_CACHE
+
+    _METRICS_CACHE = open_metrics_cache()
 
 
 class PDF(FPDF):
@@ -49,38 +180,104 @@ class PDF(FPDF):
 
     MYFONT = "diner"
 
-    def get_font_height(self, font_size, txt):
-        """create a fake page (gross) and use it to calculate font metrics"""
-        temp_pdf = PDF(orientation="L", unit="mm", format=(HEIGHT, WIDTH))
-        temp_pdf.add_font(
-            family="diner", style="", fname="./Fontdinerdotcom-unlocked.ttf", uni=True
-        )
-        temp_pdf.add_page()
-        temp_pdf.set_xy(0, 0)
-        temp_pdf.set_font(self.MYFONT, "", font_size)
-
-        # alignment probably doesn't matter here.
-        temp_pdf.multi_cell(
-            w=self.w - 1.0,
-            h=(font_size * PT_TO_MM) + LEADING,
-            align="C",
-            txt=txt,
-            border=1,
-        )
-        return temp_pdf.get_y()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # see _out()
+        self.buffer = bytearray()
+        # see get_char_widths()
+        self.char_widths = (None, None)
 
-    def get_multi_cell_height(self, w, h, txt, border=0, align="J"):
+    def _out(self, s):
         """
-        Calculate MultiCell with automatic or explicit line breaks height
-        $border is un-used, but I kept it in the parameters to keep the call
-        to this function consistent with MultiCell()
+        fpdf keeps the document in a str and copies the whole thing every
+        time it appends a line. Keep it in a bytearray instead; everything in
+        it is latin-1, so len() still gives the byte offsets fpdf expects.
+        Page content is small and stays a str until the pages are written.
         """
+        if self.state == 2:
+            super()._out(s)
+            return
+
+        if isinstance(s, str):
+            s = s.encode("latin1")
+        elif not isinstance(s, (bytes, bytearray)):
+            s = str(s).encode("latin1")
+        self.buffer += s
+        self.buffer += b"\n"
+
+    def output(self, name="", dest=""):
+        """output the PDF, writing files straight from the byte buffer"""
+        if self.state < 3:
+            self.close()
+
+        if dest.upper() == "F" or (dest == "" and name != ""):
+            with open(name, "wb") as f:
+                f.write(self.buffer)
+            return ""
+
+        # everything else expects fpdf's str buffer
+        buffer = self.buffer
+        self.buffer = buffer.decode("latin1")
+        try:
+            return super().output(name, dest)
+        finally:
+            self.buffer = buffer
+
+    def output_bytes(self):
+        """the finished PDF as bytes, where output(dest="S") gives a str"""
+        if self.state < 3:
+            self.close()
+        return bytes(self.buffer)
+
+    def add_font(self, family, style="", fname="", uni=False):
+        """add a font, reusing the parsed metrics from an earlier PDF if we can"""
+        # key on the file's size and mtime too, so a long running server
+        # picks up a font that's been replaced (say by ttfpatch)
+        try:
+            st = os.stat(fname)
+            key = (family, style, fname, uni, st.st_size, st.st_mtime_ns)
+        except OSError:
+            key = (family, style, fname, uni)
+
+        if key not in _FONT_CACHE:
+            fonts = set(self.fonts)
+            font_files = set(self.font_files)
+            super().add_font(family, style=style, fname=fname, uni=uni)
+            # the subset list is filled in as we draw, so every PDF needs its own
+            _FONT_CACHE[key] = (
+                {
+                    k: dict(v, subset=list(v.get("subset", [])))
+                    for k, v in self.fonts.items()
+                    if k not in fonts
+                },
+                {k: dict(v) for k, v in self.font_files.items() if k not in font_files},
+            )
+            return
 
-        if border < 0:
-            border = 0
+        fonts, font_files = _FONT_CACHE[key]
+        for fontkey, font in fonts.items():
+            if fontkey in self.fonts:
+                continue
+            self.fonts[fontkey] = dict(
+                font, i=len(self.fonts) + 1, subset=list(font["subset"])
+            )
+        for k, v in font_files.items():
+            self.font_files.setdefault(k, dict(v))
 
-        cw = self.current_font["cw"]
+    def get_font_height(self, font_size, txt):
+        """
+        height of txt at font_size, one row per line. This used to render txt
+        onto a throwaway page and read back get_y(), but each row is just the
+        font size plus leading, so there's no need to build a PDF for it.
+        """
+        lines = txt.count("\n") + 1
+        return ((font_size * PT_TO_MM) + LEADING) * lines
 
+    def split_text(self, w, txt):
+        """
+        the lines multi_cell() would break txt into, like its split_only
+        option, without going through the text a character at a time.
+        """
         if w == 0:
             w = self.w - self.r_margin - self.x
 
@@ -91,80 +288,118 @@ class PDF(FPDF):
         if nb > 0 and s[nb - 1] == "\n":
             nb = nb - 1
 
-        sep = -1
-        i = 0
-        j = 0
-        l = 0
-        ns = 0
-        height = 0
-
-        while i < nb:
-            # Get next character
-            c = s[i]
-
-            if c == "\n":
-                # Explicit line break
-                if self.ws > 0:
-                    self.ws = 0
-                    self._out("0 Tw")
-
-                # Increase Height
-                height += h
-                i = i + 1
-                sep = -1
-                j = i
-                l = 0
-                ns = 0
-                continue
+        lines = []
+        for para in s[:nb].split("\n"):
+            lines.extend(self.split_paragraph(para, wmax))
+
+        return lines
 
-            if c == " ":
-                sep = i
-                ls = l
-                ns = ns + 1
+    def get_multi_cell_height(self, w, h, txt, border=0, align="J"):
+        """
+        Calculate MultiCell with automatic or explicit line breaks height
+        $border and $align are un-used, but I kept them in the parameters to
+        keep the call to this function consistent with MultiCell(). Word
+        spacing for justified text doesn't move the line breaks, so unlike
+        MultiCell() this only measures and never writes to the page.
+        """
+        return len(self.split_text(w, txt)) * h
 
-            l += cw[ord(c)]
+    def get_char_widths(self):
+        """
+        character widths for the current font as a flat list indexed by code
+        point. TTF fonts already store them like that, but core fonts key them
+        by character, so build (and keep) a table for those.
+        """
+        font, widths = self.char_widths
+        if font is self.current_font:
+            return widths
 
-            if l > wmax:
-                # Automatic line break
-                if sep == -1:
-                    if i == j:
-                        i = i + 1
+        cw = self.current_font["cw"]
+        if isinstance(cw, dict):
+            widths = [cw.get(chr(i), 0) for i in range(256)]
+        else:
+            widths = cw
 
-                    if self.ws > 0:
-                        self.ws = 0
-                        self._out("0 Tw")
+        self.char_widths = (self.current_font, widths)
+        return widths
 
-                    # Increase Height
-                    height += h
-                else:
-                    if align == "J":
-                        if ns > 1:
-                            self.ws = (wmax - ls) / 1000 * self.font_size / (ns - 1)
-                        else:
-                            self.ws = 0
+    def get_text_widths(self, txt):
+        """
+        the width of each character of txt in the current font, in font units,
+        as get_string_width() would add them up
+        """
+        cw = self.get_char_widths()
+        if not txt:
+            return iter(())
+
+        # names are nearly always latin-1, and iterating the encoded bytes
+        # gives us the code points without calling ord() on every character
+        top = max(txt)
+        if top < "\u0100":
+            return map(cw.__getitem__, txt.encode("latin-1"))
+        if top < chr(len(cw)):
+            return map(cw.__getitem__, map(ord, txt))
+
+        # some of it is outside the table (emoji, say)
+        missing = 0
+        if self.unifontsubset:
+            missing = self.current_font["desc"].get("MissingWidth") or 500
+        return (cw[c] if c < len(cw) else missing for c in map(ord, txt))
+
+    def get_unit_string_width(self, txt):
+        """
+        get_string_width() at 1pt, worked out from the character widths so
+        there's no need to change the font size to measure
+        """
+        return sum(self.get_text_widths(txt)) * (1 / self.k) / 1000.0
 
-                        self._out("%.3F Tw" % self.ws * self.k)
+    def split_paragraph(self, txt, wmax):
+        """
+        split a single paragraph into the lines multi_cell() would wrap it to,
+        where wmax is in font units. Rather than summing widths a character at
+        a time we build running totals once and bisect for each break point.
+        """
+        cumw = [0]
+        cumw.extend(itertools.accumulate(self.get_text_widths(txt)))
 
-                    # Increase Height
-                    height += h
-                    i = sep + 1
+        nb = len(txt)
+        lines = []
+        j = 0
 
-                sep = -1
+        while True:
+            # first character that takes the line starting at j past wmax
+            i = bisect.bisect_right(cumw, cumw[j] + wmax) - 1
+            if i >= nb:
+                lines.append(txt[j:])
+                return lines
+
+            sep = txt.rfind(" ", j, i + 1)
+
+            if sep == -1:
+                # no space to break on, so break mid-word
+                if i == j:
+                    i += 1
+                lines.append(txt[j:i])
                 j = i
-                l = 0
-                ns = 0
             else:
-                i = i + 1
-
-        # Last chunk
-        if self.ws > 0:
-            self.ws = 0
-            self._out("0 Tw")
+                lines.append(txt[j:sep])
+                j = sep + 1
 
-        # Increase Height
-        height += h
+    def multi_cell_lines(self, w, h, lines, border=0, align="J", fill=0):
+        """
+        draw lines from split_text() the way multi_cell() would draw the text
+        they came from. border is 0 or 1.
+        """
+        last = len(lines) - 1
+        for n, line in enumerate(lines):
+            b = 0
+            if border:
+                b = "LRT" if n == 0 else "LR"
+                if n == last:
+                    b += "B"
+            self.cell(w, h, line, b, 2, align, fill)
 
-        return height
+        self.x = self.l_margin
 
     def get_longest_word(self, txt):
         """given a multi-line text, find the longest word"""
@@ -172,100 +407,182 @@ class PDF(FPDF):
         longest = max(words, key=len)
         return longest
 
-    def get_max_font_size(
-        self, text, max_width, step=FONT_STEP, font_min=FONT_MIN, font_max=FONT_MAX
-    ):
-        """find the largest possible font that can fill the page, returning font metrics"""
-        if max_width < 0:
-            max_width = 1.0
+    def set_font_size_quietly(self, size):
+        """
+        like set_font_size(), but only for measuring - it doesn't write a font
+        operator onto the page, so call set_font_size() before drawing.
+        """
+        self.font_size_pt = size
+        self.font_size = size / self.k
 
-        if step < 0:
-            step = 1.0
+    def set_font_quietly(self, family, style=""):
+        """
+        like set_font(), but only for measuring - it selects the font without
+        writing a font operator onto the page. The size is left at 0, so the
+        next set_font() or set_font_size() is sure to write one.
+        """
+        page = self.page
+        self.page = 0
+        try:
+            self.set_font(family, style, 1)
+        finally:
+            self.page = page
+        self.set_font_size_quietly(0)
+
+    def get_unit_width(self, text, longest_word=None):
+        """
+        work out which part of text limits how big it can get, returning the
+        strategy and that part's width at 1pt. String widths scale linearly
+        with the font size, so this only needs doing once per text.
+        """
+        if longest_word is None:
+            longest_word = self.get_longest_word(text)
+
+        # get_string_width is problemmatic - if you feed it 'major
+        # subtle-tease' it puts all of that together and tries to fit the
+        # length as one line ignoring word breaks. So, we use the longest
+        # word instead.
+
+        unit_width = None
+        # strategy 1, is we have a single line of text without and or & in it
+        if (
+            len(text.split()) <= MAX_TOKENS_PER_LINE
+            and text.find("&") == -1
+            and text.find("and") == -1
+        ):
+            strategy = 1
+            unit_width = self.get_unit_string_width(text)
+
+        # strategy 2, we have an & or and in the text, so use the longest part
+        if not unit_width and (text.find("&") > -1 or text.find("and") > -1):
+            strategy = 2
+
+            if text.find("and") > -1:
+                lhs = text.split("and")[0]
+                rhs = text.split("and")[1]
+
+            if text.find("&") > -1:
+                lhs = text.split("&")[0]
+                rhs = text.split("&")[1]
+
+            if len(lhs) > len(rhs):
+                unit_width = self.get_unit_string_width(lhs)
+            else:
+                unit_width = self.get_unit_string_width(rhs)
 
-        if font_min < 0:
-            font_min = 1.0
+        # if we still having figured it out, fall back to longest single word.
 
-        font_size = font_min
-        text_width = 1.0
-        text_height = 1.0
+        # strategy 3, we have multiple lines of text, so use the widest word
+        if not unit_width:
+            strategy = 3
+            unit_width = self.get_unit_string_width(longest_word)
 
-        strategy = None
-        
-        while True:
-            self.set_font_size(font_size)
-            # get_string_width is problemmatic - if you feed it 'major
-            # subtle-tease' it puts all of that together and tries to fit the
-            # length as one line ignoring word breaks. So, we use the longest
-            # word instead.
-
-            text_width = None
-            # strategy 1, is we have a single line of text without and or & in it
-            if (
-                len(text.split()) <= MAX_TOKENS_PER_LINE
-                and text.find("&") == -1
-                and text.find("and") == -1
-            ):
-                strategy = 1
-                text_width = self.get_string_width(text)
-            
-            # strategy 2, we have an & or and in the text, so use the longest part
-            if not text_width and (text.find("&") > -1 or text.find("and") > -1):
-                strategy = 2
-                
-                if text.find("and") > -1:
-                    lhs = text.split("and")[0]
-                    rhs = text.split("and")[1]
-
-                if text.find("&") > -1:
-                    lhs = text.split("&")[0]
-                    rhs = text.split("&")[1]
-                
-                if len(lhs) > len(rhs):
-                    text_width = self.get_string_width(lhs)
-                else:
-                    text_width = self.get_string_width(rhs)
-            
-            # if we still having figured it out, fall back to longest single word.                
-        
-            # strategy 2, we have multiple lines of text, so use the widest word
-            if not text_width:
-                strategy = 3
-                text_width = self.get_string_width(self.get_longest_word(text))
-
-            # HACK: maybe this is a crap idea too? Are there better font-height metrics?
-            font_height = self.get_font_height(font_size, self.get_longest_word(text))
-            text_height = self.get_multi_cell_height(
-                self.w, font_height + LEADING, text, border=0, align="C"
-            )
+        return strategy, unit_width
 
-            #print(f"\nTrying {font_size:.2f} px {font_size * PT_TO_MM:.2f} mm")
-            #print(f"font_size / font_height: {font_height:.2f}")
-            #print(f"text width: {text_width:.2f}, text height {text_height:.2f}")
+    def estimate_font_size(self, text, max_width, unit_width):
+        """
+        solve for the biggest font that fits, taking the line count at the
+        width limited size as fixed. Lines can re-wrap as the size changes,
+        so treat this as a starting point for the search, not the answer.
+        """
+        font_size_pt = self.font_size_pt
+
+        # text_width = unit_width * size
+        font_size = (max_width - self.l_margin - self.r_margin) / max(unit_width, 1e-6)
+
+        # text_height = lines * (size * PT_TO_MM + LEADING + LEADING), but the
+        # number of lines depends on the size, so go round a few times and
+        # keep the biggest size that fits the lines it wraps to
+        width_size = font_size
+        max_height = self.h - self.t_margin - self.t_margin
+        best = None
+        for _ in range(ESTIMATE_ROUNDS):
+            self.set_font_size_quietly(font_size)
+            lines = self.get_multi_cell_height(self.w, 1, text, border=0, align="C")
+            height_size = max((max_height / lines - 2 * LEADING) / PT_TO_MM, 1.0)
+
+            if height_size < font_size:
+                font_size = height_size
+                continue
 
-            if text_width > (max_width - self.l_margin - self.r_margin):
-                print(
-                    f"LIMIT: font width {text_width:.2f} mm maxed out at {max_width:.2f}"
-                )
-                font_size = font_size - step
+            best = font_size
+            if font_size >= width_size:
                 break
+            font_size = min(width_size, height_size)
 
-            # for some reason this doesn't work well and the bottom margin is always wrong.
-            if text_height > (self.h - self.t_margin - self.t_margin):
-                print(
-                    f"LIMIT:  overall text height {text_height:.2f} exceeds {self.h - self.t_margin - self.t_margin:.2f}mm"
-                )
-                font_size = font_size - step
+        if best is not None:
+            font_size = best
 
-                break
+        self.set_font_size_quietly(font_size_pt)
 
-            if font_size >= font_max:
-                print(f"LIMIT: font size maxed out at {font_size:.2f}")
-                break
+        return font_size
 
-            font_size += step  # larger step is faster, smaller step is more accurate
+    def measure_text(
+        self,
+        text,
+        font_size,
+        max_width,
+        longest_word=None,
+        strategy=None,
+        unit_width=None,
+    ):
+        """
+        measure text at one font size, returning font metrics and whether it
+        fits. pass longest_word, and strategy and unit_width (from
+        get_unit_width), if you already have them to save working them out
+        again.
+        """
+        if longest_word is None:
+            longest_word = self.get_longest_word(text)
 
-        # this is the biggest you can get without going over
-        self.set_font_size(font_size)
+        if strategy is None or unit_width is None:
+            strategy, unit_width = self.get_unit_width(text, longest_word)
+
+        text_width = unit_width * font_size
+
+        self.set_font_size_quietly(font_size)
+
+        # HACK: maybe this is a crap idea too? Are there better font-height metrics?
+        font_height = self.get_font_height(font_size, longest_word)
+
+        # strategy 1 measured the whole text, so if that's narrower than the
+        # cell it can only be one line and there's no need to wrap it
+        if (
+            strategy == 1
+            and text_width <= self.w - 2 * self.c_margin
+            and "\n" not in text
+        ):
+            text_height = font_height + LEADING
+        else:
+            text_height = self.get_multi_cell_height(
+                self.w, font_height + LEADING, text, border=0, align="C"
+            )
+
+        if DEBUG:
+            logger.debug("Trying %.2f px %.2f mm", font_size, font_size * PT_TO_MM)
+            logger.debug("font_size / font_height: %.2f", font_height)
+            logger.debug("text width: %.2f, text height %.2f", text_width, text_height)
+
+        fits = True
+
+        if text_width > (max_width - self.l_margin - self.r_margin):
+            if DEBUG:
+                logger.debug(
+                    "LIMIT: font width %.2f mm maxed out at %.2f",
+                    text_width,
+                    max_width,
+                )
+            fits = False
+
+        # for some reason this doesn't work well and the bottom margin is always wrong.
+        if text_height > (self.h - self.t_margin - self.t_margin):
+            if DEBUG:
+                logger.debug(
+                    "LIMIT:  overall text height %.2f exceeds %.2fmm",
+                    text_height,
+                    self.h - self.t_margin - self.t_margin,
+                )
+            fits = False
 
         return {
             "strategy": strategy,
@@ -273,8 +590,141 @@ class PDF(FPDF):
             "font_height": font_height,
             "text_width": text_width,
             "text_height": text_height,
+            "fits": fits,
         }
 
+    def get_metrics_key(
+        self, text, max_width, step=FONT_STEP, font_min=FONT_MIN, font_max=FONT_MAX
+    ):
+        """
+        the metrics cache key for fitting text with these settings. The font
+        file's size and mtime are in there so a replaced font isn't fitted
+        with the old one's sizes.
+        """
+        st = os.stat(FONT_FILE)
+        return (
+            f"{METRICS_CACHE_VERSION}|{text}|{self.MYFONT}|{st.st_size}"
+            f"|{st.st_mtime_ns}|{max_width:.3f}|{self.h:.3f}|{step}|{font_min}"
+            f"|{font_max}"
+        )
+
+    def get_max_font_size(
+        self,
+        text,
+        max_width,
+        step=FONT_STEP,
+        font_min=FONT_MIN,
+        font_max=FONT_MAX,
+    ):
+        """
+        find the largest possible font that can fill the page, returning font
+        metrics. The search starts from estimate_font_size().
+        """
+        if max_width < 0:
+            max_width = 1.0
+
+        if step <= 0:
+            step = 1.0
+
+        if font_min < 0:
+            font_min = 1.0
+
+        key = self.get_metrics_key(text, max_width, step, font_min, font_max)
+        cache = get_metrics_cache()
+        if key in cache:
+            metrics = dict(cache[key])
+            self.set_font_size(metrics["font_size"])
+            return metrics
+
+        longest_word = self.get_longest_word(text)
+        strategy, unit_width = self.get_unit_width(text, longest_word)
+        font_size_pt = self.font_size_pt
+
+        def fits(n):
+            return self.measure_text(
+                text,
+                font_min + n * step,
+                max_width,
+                longest_word,
+                strategy,
+                unit_width,
+            )["fits"]
+
+        # "fits" is monotonic in font size, so bisect over the sizes
+        # font_min, font_min + step, ... font_max instead of walking them all.
+        # lo always fits (or is font_min), hi never fits.
+        last = int((font_max - font_min) // step)
+        lo = 0
+        hi = last + 1
+
+        # text_width is linear in the size, so we can work out where the text
+        # gets too wide without measuring anything and never look past there
+        max_text_width = max_width - self.l_margin - self.r_margin
+        if unit_width > 0:
+            widest = int((max_text_width / unit_width - font_min) // step)
+            # nudge for rounding so this agrees exactly with measure_text
+            while (
+                widest + 1 < hi
+                and unit_width * (font_min + (widest + 1) * step) <= max_text_width
+            ):
+                widest += 1
+            while (
+                widest >= 0 and unit_width * (font_min + widest * step) > max_text_width
+            ):
+                widest -= 1
+            hi = min(hi, max(widest + 1, 1))
+
+        estimate = self.estimate_font_size(text, max_width, unit_width)
+
+        # gallop out from the estimate until we've bracketed the answer
+        guess = min(max(int((estimate - font_min) // step), 0), hi - 1)
+        span = SEARCH_SPAN
+        if fits(guess):
+            lo = guess
+            while lo + span < hi:
+                if not fits(lo + span):
+                    hi = lo + span
+                    break
+                lo += span
+                span *= 2
+        else:
+            hi = guess
+            while hi - span > lo:
+                if fits(hi - span):
+                    lo = hi - span
+                    break
+                hi -= span
+                span *= 2
+
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if fits(mid):
+                lo = mid
+            else:
+                hi = mid
+
+        if DEBUG and lo == last:
+            logger.debug("LIMIT: font size maxed out at %.2f", font_min + lo * step)
+
+        # this is the biggest you can get without going over
+        metrics = self.measure_text(
+            text,
+            font_min + lo * step,
+            max_width,
+            longest_word,
+            strategy,
+            unit_width,
+        )
+        del metrics["fits"]
+        cache[key] = metrics
+
+        # the probes didn't touch the page, so put back the size it has and
+        # then really set the new one
+        self.set_font_size_quietly(font_size_pt)
+        self.set_font_size(metrics["font_size"])
+
+        return dict(metrics)
+
     def make_labelled_line(self, y1, r, g, b, label):
         """draw a dashed line with a label in the current font and color"""
         font_size = 30
@@ -287,10 +737,11 @@ class PDF(FPDF):
         self.dashed_line(0, y1, self.w, y1, 3, 2)
 
     def add_name(self, txt):
-        """add one large name to the page"""
-        # setup font
+        """add one large name to the page, returning its font metrics"""
+        # setup font. get_max_font_size() writes the size it settles on, so
+        # there's no point putting a placeholder size on the page first
         self.set_xy(0.0, 0.0)
-        self.set_font(self.MYFONT, "", 100)
+        self.set_font_quietly(self.MYFONT)
         self.set_text_color(0, 0, 0)
 
         metrics = self.get_max_font_size(txt, self.w)
@@ -304,12 +755,12 @@ class PDF(FPDF):
         y_offset = ((self.h - self.t_margin) / 2) - (metrics["text_height"] / 2)
 
         if DEBUG:
-            print(f"      strategy: {metrics['strategy']}")
-            print(f"   page height: {self.h:.2f}")
-            print(f"   t_margin:    {self.t_margin:.2f}")
-            print(f'   text_height: {metrics["text_height"]:.2f}')
-            print(f'   font_height: {metrics["font_height"]:.2f}')
-            print(f"   y_offset: {y_offset}")
+            logger.debug("      strategy: %s", metrics["strategy"])
+            logger.debug("   page height: %.2f", self.h)
+            logger.debug("   t_margin:    %.2f", self.t_margin)
+            logger.debug("   text_height: %.2f", metrics["text_height"])
+            logger.debug("   font_height: %.2f", metrics["font_height"])
+            logger.debug("   y_offset: %s", y_offset)
             self.make_labelled_line(y_offset, 0, 255, 0, "YOFFSET")
 
         self.set_xy(0, y_offset)
@@ -317,44 +768,50 @@ class PDF(FPDF):
         self.set_text_color(0, 0, 0)
         self.set_font(self.MYFONT, "", metrics["font_size"])
 
-        # Finally, draw our text!
+        # Finally, draw our text! we already know where the lines break, so
+        # draw them as cells rather than have multi_cell() work it out again
+        border = 0
         if DEBUG:
             self.set_draw_color(255, 0, 255)
-            self.multi_cell(
-                w=self.w,
-                h=metrics["font_height"] + LEADING,
-                align="C",
-                txt=txt,
-                border=1,
-            )
-        else:
-            self.multi_cell(
-                w=self.w,
-                h=metrics["font_height"] + LEADING,
-                align="C",
-                txt=txt,
-                border=0,
-            )
+            border = 1
 
+        self.multi_cell_lines(
+            w=self.w,
+            h=metrics["font_height"] + LEADING,
+            lines=self.split_text(self.w, txt),
+            align="C",
+            border=border,
+        )
 
-def make_sign(line, output_dir=OUTDIR):
+        return metrics
+
+
+def new_sign_pdf():
+    """a blank sign-sized PDF with our font loaded, ready for add_sign_page()"""
     # full syntax
     pdf = PDF(orientation="L", unit="mm", format=(HEIGHT, WIDTH))
 
     # sometimes if we are close to the page limits which casues auto page break
     # to fire and create new pages. turn this off.
     pdf.set_auto_page_break(False)
-    pdf.add_font(
-        family="diner", style="", fname="./Fontdinerdotcom-unlocked.ttf", uni=True
-    )
+
+    # a page is one name and is only a few hundred bytes, so compressing it
+    # saves a couple of dozen bytes for a zlib call per page. The font is
+    # compressed either way.
+    pdf.set_compression(False)
+    pdf.add_font(family=PDF.MYFONT, style="", fname=FONT_FILE, uni=True)
+    return pdf
+
+
+def add_sign_page(pdf, line):
+    """add a page to pdf with one name on it, returning its font metrics"""
     pdf.add_page()
 
     # draw the margins if we can
     if DEBUG:
-        print("\n")
-        print(f"page WIDTH: {pdf.w:.2f} page height: {pdf.h:.2f}")
-        print(f"marginL: {pdf.l_margin:.2f} marginR: {pdf.r_margin:.2f}")
-        print(f"marginT: {pdf.t_margin:.2f} marginB: {pdf.b_margin:.2f}")
+        logger.debug("page WIDTH: %.2f page height: %.2f", pdf.w, pdf.h)
+        logger.debug("marginL: %.2f marginR: %.2f", pdf.l_margin, pdf.r_margin)
+        logger.debug("marginT: %.2f marginB: %.2f", pdf.t_margin, pdf.b_margin)
 
         # draw that.
         pdf.set_draw_color(255, 255, 0)
@@ -371,35 +828,160 @@ def make_sign(line, output_dir=OUTDIR):
             "D",
         )
 
-    print(f"\n{line.strip()}\n")
+    logger.info("%s", line.strip())
 
     # place the name
     # if there are < 3 tokes, we don't break the line (e.g. 'Leon G. Ray')
-    pdf.add_name(line.strip())
-    outputfn = output_dir + "/" + line.strip().replace(" ", "_") + ".pdf"
-    pdf.output(outputfn, "F")
+    return pdf.add_name(line.strip())
 
-def make_from_file():
-    """program start"""
-    namefile = open("names.txt", "r", encoding="utf-8")
 
-    for line in namefile:
-        if len(line.strip()) < 2:
-            print("skipping blank.")
-            continue
-        print("make" + line.strip())
-        make_sign(line)
+def make_sign_pdf(line):
+    """make one sign, returning its file name and the PDF as bytes"""
+    pdf = new_sign_pdf()
+    add_sign_page(pdf, line)
+    return line.strip().translate(_FILENAME_TRANS) + ".pdf", pdf.output_bytes()
+
+
+def make_signs_in_one(names, outputfn):
+    """
+    make one PDF with a page per name. Embedding the font is most of the cost
+    of writing a PDF, and this only does it once for the whole lot.
+    """
+    pdf = new_sign_pdf()
+    for line in names:
+        add_sign_page(pdf, line)
+    pdf.output(outputfn, "F")
 
 
-def make_signs_from_lines(lines, output_dir, base_name=None):
+def clean_names(lines):
+    """
+    strip names, drop characters the PDF can't hold, and drop blanks and
+    repeats, keeping them in order
+    """
+    names = []
     for line in lines:
-        if len(line.strip()) < 2:
-            print("skipping blank.")
+        line = _OUTSIDE_BMP.sub("", line).strip()
+        if len(line) < 2:
+            logger.info("skipping blank.")
             continue
-        make_sign(line, output_dir)
+        names.append(line)
+
+    # a repeated name would just write over its own PDF, so only make it once
+    return list(dict.fromkeys(names))
+
+
+def make_sign_run(names, metrics):
+    """
+    pool worker: make a run of signs in order, returning (file name, PDF)
+    pairs and the metrics that were added. metrics holds whatever the parent
+    already had cached for these names.
+    """
+    global _METRICS_CACHE
+
+    # the shelf can't take writes from several processes at once, so new
+    # entries go in a layer of their own that's handed back to the parent
+    _METRICS_CACHE = collections.ChainMap({}, metrics)
+
+    pdfs = [make_sign_pdf(line) for line in names]
+
+    return pdfs, _METRICS_CACHE.maps[0]
+
+
+def number_duplicates(pdfs):
+    """
+    names that only differ in characters _FILENAME_TRANS replaces (AC/DC and
+    AC_DC, say) end up with the same file name, so number the repeats rather
+    than have them overwrite each other. Case is ignored, as it is on a Mac.
+    """
+    seen = set()
+    for filename, data in pdfs:
+        base, ext = os.path.splitext(filename)
+        n = 1
+        while filename.casefold() in seen:
+            n += 1
+            filename = f"{base}_{n}{ext}"
+        seen.add(filename.casefold())
+        yield filename, data
+
+
+def make_signs(names, output_dir=OUTDIR, processes=None, archive=None):
+    """
+    make signs for already cleaned names, spreading them over processes. The
+    PDFs are written to output_dir, or if archive (a path or file object) is
+    given, straight into a zip there instead.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(names) // MIN_NAMES_PER_PROCESS)
+
+    if processes <= 1:
+        pdfs = [make_sign_pdf(line) for line in names]
+    else:
+        size = -(-len(names) // processes)
+        runs = [names[i : i + size] for i in range(0, len(names), size)]
+
+        # only send each worker the entries for its own names
+        cache = get_metrics_cache()
+        pdf = new_sign_pdf()
+        args = []
+        for run in runs:
+            keys = (pdf.get_metrics_key(line.strip(), pdf.w) for line in run)
+            args.append((run, {k: cache[k] for k in keys if k in cache}))
+
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(make_sign_run, args)
+
+        pdfs = []
+        for run, metrics in results:
+            pdfs.extend(run)
+            cache.update(metrics)
+
+    pdfs = number_duplicates(pdfs)
+
+    if archive is not None:
+        with zipfile.ZipFile(
+            archive, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_LEVEL
+        ) as zf:
+            for filename, data in pdfs:
+                zf.writestr(filename, data)
+        return
+
+    for filename, data in pdfs:
+        with open(os.path.join(output_dir, filename), "wb") as f:
+            f.write(data)
+
+
+def make_from_file(all_in_one=False):
+    """program start. all_in_one puts every sign in one PDF instead of one each"""
+    lines = pathlib.Path("names.txt").read_text(encoding="utf-8").splitlines()
+
+    if all_in_one:
+        make_signs_in_one(clean_names(lines), OUTDIR + "/" + ALL_IN_ONE_NAME)
+        return
+
+    make_signs_from_lines(lines, OUTDIR)
+
+
+def make_signs_from_lines(lines, output_dir=OUTDIR, base_name=None):
+    """
+    make signs for lines of names in output_dir. If base_name is given they go
+    straight into base_name.zip instead, and output_dir isn't used at all.
+    """
+    archive = base_name + ".zip" if base_name else None
+    make_signs(clean_names(lines), output_dir, archive=archive)
+
+
+def make_signs_zip(lines):
+    """make signs for lines of names, returning them zipped up in a BytesIO"""
+    archive = io.BytesIO()
+    make_signs(clean_names(lines), archive=archive)
+    archive.seek(0)
+    return archive
 
-    if base_name:
-        shutil.make_archive(base_name=base_name, format="zip", root_dir=output_dir)
 
 if __name__ == "__main__":
-    make_from_file()
+    logging.basicConfig(
+        level=logging.DEBUG if DEBUG else logging.INFO, format="%(message)s"
+    )
+    use_metrics_shelf()
+    make_from_file(all_in_one="--all-in-one" in sys.argv[1:])
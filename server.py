@@ -5,9 +5,8 @@
   web server to create signs and return them
 """
 import os
-from make_signs import make_signs_from_lines
+from make_signs import make_signs_zip
 from flask import Flask, request, send_from_directory, render_template, send_file
-import uuid
 
 app = Flask(__name__, static_url_path='/signs/static', static_folder='static')
 
@@ -29,12 +28,8 @@ def get_file(filename):  # pragma: no cover
 @app.route('/signs/make', methods = ['POST'])
 def make():
     data = request.form['namelist']
-    id = str(uuid.uuid4())
-    output_dir = 'output/' + id
-    os.makedirs(output_dir)
-    base_name = 'output/' + id
-    make_signs_from_lines(data.split('\n'), output_dir=output_dir, base_name=base_name)
-    return send_file(base_name + '.zip',
+    archive = make_signs_zip(data.split('\n'))
+    return send_file(archive,
                      mimetype='application/zip', 
                      download_name='signs.zip', 
                      as_attachment=True)